@@ -3,7 +3,15 @@ import pandas as pd
 import numpy as np
 import re
 import os
-from typing import Optional, List
+import glob
+import time
+import tempfile
+from typing import Optional, List, Iterable, Iterator
+
+import openpyxl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 # ==========================================================
 # CONFIG
@@ -227,6 +235,82 @@ PESO_RETEN_PT = {
     "16+ dias retido": 20,
 }
 
+# ==========================================================
+# LEITURA EM BLOCOS (arquivos maiores que a memória)
+# ==========================================================
+LIMIAR_ARQUIVO_GRANDE_MB = 50
+TAMANHO_BLOCO = 50_000
+# pasta dos Parquet convertidos (evite tmpfs: ocupa RAM); sobrescreva por variável de ambiente
+PASTA_ARQUIVO_GRANDE = os.environ.get("RADAR_RETIDOS_TMPDIR", tempfile.gettempdir())
+IDADE_MAX_ARQUIVO_GRANDE_H = 12
+
+def remover_arquivo(caminho: str):
+    try:
+        os.remove(caminho)
+    except FileNotFoundError:
+        pass
+
+@st.cache_resource(show_spinner=False)
+def limpar_parquets_antigos(pasta: str = PASTA_ARQUIVO_GRANDE, idade_max_h: float = IDADE_MAX_ARQUIVO_GRANDE_H):
+    # sessões encerradas não avisam o servidor: uma vez por processo, apaga
+    # conversões (e parciais) sem uso há mais de `idade_max_h`
+    limite = time.time() - idade_max_h * 3600
+    for caminho in glob.glob(os.path.join(pasta, "radar_retidos_*.parquet*")):
+        try:
+            if os.path.getmtime(caminho) < limite:
+                os.remove(caminho)
+        except OSError:
+            pass
+
+limpar_parquets_antigos()
+
+def _nomes_colunas(cabecalho) -> List[str]:
+    # mesma nomeação do pd.read_excel: vazias -> "Unnamed: i", repetidas -> "X.1"
+    nomes, vistos = [], {}
+    for i, c in enumerate(cabecalho):
+        nome = f"Unnamed: {i}" if c is None else str(c)
+        if nome in vistos:
+            vistos[nome] += 1
+            nome = f"{nome}.{vistos[nome]}"
+        else:
+            vistos[nome] = 0
+        nomes.append(nome)
+    return nomes
+
+def _bloco_df(linhas: list, colunas: List[str]) -> pd.DataFrame:
+    n = len(colunas)
+    linhas = [tuple(l[:n]) + (None,) * (n - len(l)) for l in linhas]
+    d = pd.DataFrame(linhas, columns=colunas, dtype=object)
+    return d.mask(d.isna())
+
+def ler_cabecalho_xlsx(arquivo) -> List[str]:
+    arquivo.seek(0)
+    wb = openpyxl.load_workbook(arquivo, read_only=True, data_only=True)
+    try:
+        return _nomes_colunas(next(wb.worksheets[0].iter_rows(values_only=True), ()))
+    finally:
+        wb.close()
+
+def iterar_blocos_xlsx(arquivo, tamanho_bloco: int = TAMANHO_BLOCO) -> Iterator[pd.DataFrame]:
+    """Lê a primeira aba em streaming, `tamanho_bloco` linhas por vez (sempre emite ao menos um bloco)."""
+    arquivo.seek(0)
+    wb = openpyxl.load_workbook(arquivo, read_only=True, data_only=True)
+    try:
+        linhas = wb.worksheets[0].iter_rows(values_only=True)
+        colunas = _nomes_colunas(next(linhas, ()))
+        buffer, emitiu = [], False
+        for linha in linhas:
+            if all(v is None for v in linha):
+                continue
+            buffer.append(linha)
+            if len(buffer) >= tamanho_bloco:
+                yield _bloco_df(buffer, colunas)
+                buffer, emitiu = [], True
+        if buffer or not emitiu:
+            yield _bloco_df(buffer, colunas)
+    finally:
+        wb.close()
+
 # ==========================================================
 # UPLOAD
 # ==========================================================
@@ -235,16 +319,30 @@ if not arquivo:
     st.info("Faça upload do Excel para gerar automaticamente ranking, farol, alertas e análises.")
     st.stop()
 
-df = pd.read_excel(arquivo)
+modo_grande = st.checkbox(
+    "Modo arquivo grande (processa em blocos, sem carregar a planilha inteira na memória)",
+    value=arquivo.size >= LIMIAR_ARQUIVO_GRANDE_MB * 1024 * 1024,
+    help=(
+        "Converte o Excel em blocos para um arquivo colunar (Parquet) em disco e calcula os relatórios "
+        "por agregação parcial. No Detalhado, só as linhas da unidade escolhida são carregadas."
+    ),
+)
+
+if modo_grande:
+    df = None
+    colunas_planilha = ler_cabecalho_xlsx(arquivo)
+else:
+    df = pd.read_excel(arquivo)
+    colunas_planilha = list(df.columns)
 
 # ==========================================================
 # VALIDAÇÃO MÍNIMA
 # ==========================================================
 colunas_necessarias = ["Remessa", "Nome da base de entrega", "Tempo de retenção"]
-faltando = [c for c in colunas_necessarias if c not in df.columns]
+faltando = [c for c in colunas_necessarias if c not in colunas_planilha]
 if faltando:
     st.error(f"Faltam colunas na planilha: {faltando}")
-    st.write("Colunas disponíveis:", list(df.columns))
+    st.write("Colunas disponíveis:", colunas_planilha)
     st.stop()
 
 # ==========================================================
@@ -307,22 +405,11 @@ def preparar_base_coord(df_coord_in: pd.DataFrame) -> tuple[Optional[pd.DataFram
 
     return out, msg
 
-df["Nome da base de entrega"] = df["Nome da base de entrega"].apply(_norm_text)
-
 df_coord_p = None
 if df_coord is not None and not df_coord.empty:
     df_coord_p, prep_msg = preparar_base_coord(df_coord)
     coord_status_msg = prep_msg
 
-# merge se tiver base tratada
-if df_coord_p is not None:
-    df = df.merge(df_coord_p, on="Nome da base de entrega", how="left")
-
-# ✅ GARANTIR COLUNAS (evita KeyError SEMPRE)
-for col in ["Coordenador", "UF", "Filial"]:
-    if col not in df.columns:
-        df[col] = pd.NA
-
 # ==========================================================
 # DETECTAR COLUNAS DE MOTORISTA E OCORRÊNCIA
 # ==========================================================
@@ -335,33 +422,175 @@ driver_candidates = [
 occ_candidates = [
     "Tipo problemático", "Ocorrência", "Ocorrencia", "Motivo", "Status", "Reason", "Exception"
 ]
-col_driver = pick_first_existing(df, driver_candidates)
-col_occ = pick_first_existing(df, occ_candidates)
-
-if col_driver:
-    df[col_driver] = normalize_text_series(df[col_driver])
-if col_occ:
-    df[col_occ] = normalize_text_series(df[col_occ])
+cabecalho = pd.DataFrame(columns=colunas_planilha)
+col_driver = pick_first_existing(cabecalho, driver_candidates)
+col_occ = pick_first_existing(cabecalho, occ_candidates)
 
 # ==========================================================
-# COLUNAS DERIVADAS
+# ENRIQUECIMENTO + COLUNAS DERIVADAS
 # ==========================================================
-df["Tempo de retenção (PT)"] = (
-    df["Tempo de retenção"]
-    .astype(str)
-    .str.strip()
-    .map(MAPA_RETENCAO_PT)
-    .fillna(df["Tempo de retenção"].astype(str).str.strip())
-)
+def enriquecer_retidos(d: pd.DataFrame) -> pd.DataFrame:
+    d["Nome da base de entrega"] = d["Nome da base de entrega"].apply(_norm_text)
 
-df["Peso Criticidade"] = (
-    df["Tempo de retenção (PT)"].map(PESO_RETEN_PT)
-    .fillna(df["Tempo de retenção"].apply(extrair_peso_cn))
-    .fillna(0)
-    .astype(float)
-)
+    # merge se tiver base tratada
+    if df_coord_p is not None:
+        d = d.merge(df_coord_p, on="Nome da base de entrega", how="left")
+
+    # ✅ GARANTIR COLUNAS (evita KeyError SEMPRE)
+    for col in ["Coordenador", "UF", "Filial"]:
+        if col not in d.columns:
+            d[col] = pd.NA
+
+    if col_driver:
+        d[col_driver] = normalize_text_series(d[col_driver])
+    if col_occ:
+        d[col_occ] = normalize_text_series(d[col_occ])
+
+    d["Tempo de retenção (PT)"] = (
+        d["Tempo de retenção"]
+        .astype(str)
+        .str.strip()
+        .map(MAPA_RETENCAO_PT)
+        .fillna(d["Tempo de retenção"].astype(str).str.strip())
+    )
+
+    d["Peso Criticidade"] = (
+        d["Tempo de retenção (PT)"].map(PESO_RETEN_PT)
+        .fillna(d["Tempo de retenção"].apply(extrair_peso_cn))
+        .fillna(0)
+        .astype(float)
+    )
 
-df["Tipo Unidade"] = df["Nome da base de entrega"].apply(eh_franquia).map({True: "Franquia", False: "Base própria"})
+    d["Tipo Unidade"] = d["Nome da base de entrega"].apply(eh_franquia).map({True: "Franquia", False: "Base própria"})
+    return d
+
+# combinações distintas usadas para montar as opções da sidebar
+COLUNAS_OPCOES = ["Tipo Unidade", "Coordenador", "UF", "Filial", "Tempo de retenção (PT)"]
+
+def _tipo_coluna(serie: pd.Series) -> Optional[str]:
+    # tipo da coluna num bloco, como o pd.read_excel inferiria (None = só vazios)
+    if serie.isna().all():
+        return None
+    if pd.api.types.is_bool_dtype(serie):
+        return "texto"
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return "data"
+    if pd.api.types.is_integer_dtype(serie):
+        return "inteiro"
+    if pd.api.types.is_float_dtype(serie):
+        return "decimal"
+    return "texto"
+
+def _unir_tipos(a: Optional[str], b: Optional[str]) -> Optional[str]:
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if {a, b} == {"inteiro", "decimal"}:
+        return "decimal"
+    return "texto"
+
+def _converter_tipo(serie: pd.Series, tipo: str) -> pd.Series:
+    if tipo == "data":
+        return pd.to_datetime(serie)
+    if tipo == "inteiro":
+        return serie.astype("int64")
+    if tipo == "decimal":
+        return serie.astype("float64")
+    return serie.astype("string")
+
+def converter_xlsx_para_parquet(arquivo, destino: str) -> tuple[pd.DataFrame, dict]:
+    """
+    Enriquece o Excel bloco a bloco e grava em Parquet, em duas passadas:
+    1) cada bloco vai para um arquivo parcial com os próprios tipos, enquanto se
+       acumula o tipo de cada coluna no arquivo todo;
+    2) os parciais são unidos num único Parquet com esse tipo final (nada é
+       descartado: colunas com tipos conflitantes viram texto).
+    Devolve as combinações de filtros e o índice unidade -> row groups.
+    """
+    chaves = set(COLUNAS_OPCOES + ["Nome da base de entrega", "Remessa", "Tempo de retenção"])
+    chaves.update(c for c in (col_driver, col_occ) if c)
+
+    partes = []
+    tipos, com_vazios = {}, set()
+    opcoes = None
+    indice = {}
+    writer = None
+    concluido = False
+    try:
+        for bloco in iterar_blocos_xlsx(arquivo):
+            bloco = enriquecer_retidos(bloco)
+            novas = bloco[COLUNAS_OPCOES].drop_duplicates()
+            opcoes = novas if opcoes is None else pd.concat([opcoes, novas]).drop_duplicates()
+
+            inferido = bloco.infer_objects()
+            for c in bloco.columns:
+                tipo = "texto" if c in chaves else _tipo_coluna(inferido[c])
+                tipos[c] = _unir_tipos(tipos.get(c), tipo)
+                if inferido[c].isna().any():
+                    com_vazios.add(c)
+                bloco[c] = inferido[c] if tipo in ("data", "inteiro", "decimal") else bloco[c].astype("string")
+
+            parte = f"{destino}.parte{len(partes)}"
+            partes.append(parte)
+            pq.write_table(pa.Table.from_pandas(bloco, preserve_index=False), parte)
+
+        # mesma regra do pandas: inteiro com vazios vira decimal
+        tipos["Peso Criticidade"] = "decimal"
+        for c, tipo in tipos.items():
+            if tipo is None:
+                tipos[c] = "texto"
+            elif tipo == "inteiro" and c in com_vazios:
+                tipos[c] = "decimal"
+
+        grupo = 0
+        for parte in partes:
+            bloco = pq.read_table(parte).to_pandas()
+            for c, tipo in tipos.items():
+                bloco[c] = _converter_tipo(bloco[c], tipo)
+            if writer is None:
+                writer = pq.ParquetWriter(destino, pa.Schema.from_pandas(bloco, preserve_index=False))
+            if len(bloco):
+                tabela = pa.Table.from_pandas(bloco, schema=writer.schema, preserve_index=False)
+                writer.write_table(tabela, row_group_size=len(bloco))
+                for unidade in bloco["Nome da base de entrega"].unique():
+                    indice.setdefault(unidade, []).append(grupo)
+                grupo += 1
+            remover_arquivo(parte)
+        concluido = True
+    finally:
+        if writer is not None:
+            writer.close()
+        for parte in partes:
+            remover_arquivo(parte)
+        if not concluido:
+            remover_arquivo(destino)
+    return opcoes.reset_index(drop=True), {u: tuple(g) for u, g in indice.items()}
+
+estado = st.session_state.get("arquivo_grande")
+# o Parquet some se o modo for desligado, se chegar outro arquivo ou se a limpeza
+# por idade (de outro processo) apagou o arquivo de uma aba parada: reconverte
+if estado is not None and (
+    not modo_grande or estado["id"] != arquivo.file_id or not os.path.exists(estado["caminho"])
+):
+    remover_arquivo(estado["caminho"])
+    del st.session_state["arquivo_grande"]
+    estado = None
+
+if modo_grande:
+    if estado is None:
+        caminho = os.path.join(PASTA_ARQUIVO_GRANDE, f"radar_retidos_{arquivo.file_id}.parquet")
+        with st.spinner("Convertendo o Excel em blocos para Parquet..."):
+            opcoes, indice = converter_xlsx_para_parquet(arquivo, caminho)
+        estado = {"id": arquivo.file_id, "caminho": caminho, "opcoes": opcoes, "indice": indice}
+        st.session_state["arquivo_grande"] = estado
+    else:
+        # marca como em uso para a limpeza por idade não apagar a sessão ativa
+        os.utime(estado["caminho"])
+    df_opcoes = estado["opcoes"]
+else:
+    df = enriquecer_retidos(df)
+    df_opcoes = df
 
 # ==========================================================
 # SIDEBAR FILTROS
@@ -375,24 +604,31 @@ tipo_sel = st.sidebar.multiselect(
 )
 
 # ✅ agora não quebra, pois as colunas SEMPRE existem
-coord_opts = sorted([x for x in df["Coordenador"].dropna().astype(str).unique().tolist() if x.strip() != ""])
-uf_opts = sorted([x for x in df["UF"].dropna().astype(str).unique().tolist() if x.strip() != ""])
-filial_opts = sorted([x for x in df["Filial"].dropna().astype(str).unique().tolist() if x.strip() != ""])
+coord_opts = sorted([x for x in df_opcoes["Coordenador"].dropna().astype(str).unique().tolist() if x.strip() != ""])
+uf_opts = sorted([x for x in df_opcoes["UF"].dropna().astype(str).unique().tolist() if x.strip() != ""])
+filial_opts = sorted([x for x in df_opcoes["Filial"].dropna().astype(str).unique().tolist() if x.strip() != ""])
 
 coord_sel = st.sidebar.multiselect("Coordenador", options=coord_opts, default=coord_opts) if coord_opts else []
 uf_sel = st.sidebar.multiselect("UF", options=uf_opts, default=uf_opts) if uf_opts else []
 filial_sel = st.sidebar.multiselect("Filial", options=filial_opts, default=filial_opts) if filial_opts else []
 
-df_f = df[df["Tipo Unidade"].isin(tipo_sel)].copy()
+def aplicar_filtros(d: pd.DataFrame, filtros: dict) -> pd.DataFrame:
+    for col, valores in filtros.items():
+        d = d[d[col].astype(str).isin(valores)]
+    return d.copy()
+
+filtros = {"Tipo Unidade": tipo_sel}
 if coord_opts:
-    df_f = df_f[df_f["Coordenador"].astype(str).isin(coord_sel)].copy()
+    filtros["Coordenador"] = coord_sel
 if uf_opts:
-    df_f = df_f[df_f["UF"].astype(str).isin(uf_sel)].copy()
+    filtros["UF"] = uf_sel
 if filial_opts:
-    df_f = df_f[df_f["Filial"].astype(str).isin(filial_sel)].copy()
+    filtros["Filial"] = filial_sel
+
+recorte = aplicar_filtros(df_opcoes, filtros)
 
 # Tempo de retenção (PT)
-reten_unique = df_f["Tempo de retenção (PT)"].astype(str).unique().tolist()
+reten_unique = recorte["Tempo de retenção (PT)"].astype(str).unique().tolist()
 reten_options = [x for x in ORDEM_RETEN_PT if x in reten_unique] + [x for x in reten_unique if x not in ORDEM_RETEN_PT]
 
 reten_sel = st.sidebar.multiselect(
@@ -400,7 +636,9 @@ reten_sel = st.sidebar.multiselect(
     options=reten_options,
     default=reten_options
 )
-df_f = df_f[df_f["Tempo de retenção (PT)"].astype(str).isin(reten_sel)].copy()
+filtros["Tempo de retenção (PT)"] = reten_sel
+
+df_f = None if modo_grande else aplicar_filtros(recorte, {"Tempo de retenção (PT)": reten_sel})
 
 # Top N e limiares
 top_n = st.sidebar.slider("Top N (listas)", 5, 50, 15)
@@ -411,89 +649,173 @@ limiar_alerta_mais15 = st.sidebar.slider("Alerta por Qtd 16+ dias", 5, 100, 30)
 # ==========================================================
 # AGREGAÇÕES
 # ==========================================================
-def build_base_rank(d: pd.DataFrame) -> pd.DataFrame:
-    grp_cols = ["Nome da base de entrega", "Tipo Unidade", "Coordenador", "UF", "Filial"]
-
-    base_rank = (
-        d.groupby(grp_cols, dropna=False)
+# Cada relatório é calculado em duas etapas: um parcial aditivo por bloco
+# (contagens e somas) e a finalização sobre os parciais já somados. Assim o
+# modo em memória (um bloco só) e o modo arquivo grande dão o mesmo resultado.
+GRP_BASE = ["Nome da base de entrega", "Tipo Unidade", "Coordenador", "UF", "Filial"]
+
+def somar_parciais(acum: Optional[pd.DataFrame], parcial: pd.DataFrame, chaves: List[str]) -> pd.DataFrame:
+    if acum is None:
+        return parcial
+    return pd.concat([acum, parcial], ignore_index=True).groupby(chaves, dropna=False, as_index=False).sum()
+
+def somar_contagens(acum: Optional[pd.Series], parcial: pd.Series) -> pd.Series:
+    return parcial if acum is None else acum.add(parcial, fill_value=0)
+
+def parcial_base_rank(d: pd.DataFrame) -> pd.DataFrame:
+    return (
+        d.assign(_mais15=(d["Peso Criticidade"] >= 20).astype(int))
+        .groupby(GRP_BASE, dropna=False)
         .agg(
             Retidos=("Remessa", "count"),
             Soma_Peso=("Peso Criticidade", "sum"),
-            Media_Criticidade=("Peso Criticidade", "mean"),
+            Linhas=("Peso Criticidade", "size"),
+            Qtd_16=("_mais15", "sum"),
         )
         .reset_index()
     )
 
-    total = max(len(d), 1)
-    base_rank["% Participação"] = base_rank["Retidos"] / total
+def finalizar_base_rank(parcial: pd.DataFrame, total: int) -> pd.DataFrame:
+    base_rank = parcial.copy()
+    base_rank["Media_Criticidade"] = base_rank["Soma_Peso"] / base_rank["Linhas"]
+    base_rank["% Participação"] = base_rank["Retidos"] / max(total, 1)
     base_rank["Farol (%)"] = base_rank["% Participação"].apply(farol_participacao)
-
-    mais15 = (
-        d[d["Peso Criticidade"] >= 20]
-        .groupby("Nome da base de entrega")
-        .size()
-        .reset_index(name="Qtd_16+")
-    )
-    base_rank = base_rank.merge(mais15, on="Nome da base de entrega", how="left")
-    base_rank["Qtd_16+"] = base_rank["Qtd_16+"].fillna(0).astype(int)
+    base_rank["Qtd_16+"] = base_rank["Qtd_16"].astype(int)
 
     base_rank["Score Misto"] = (
         (base_rank["Retidos"] / max(base_rank["Retidos"].max(), 1)) * 0.6 +
         (base_rank["Media_Criticidade"] / max(base_rank["Media_Criticidade"].max(), 1)) * 0.4
     )
-    return base_rank
+    cols = GRP_BASE + [
+        "Retidos", "Soma_Peso", "Media_Criticidade", "% Participação", "Farol (%)", "Qtd_16+", "Score Misto"
+    ]
+    return base_rank[cols]
 
-def build_reten_dist(d: pd.DataFrame) -> pd.DataFrame:
-    reten_dist = (
+def build_base_rank(d: pd.DataFrame) -> pd.DataFrame:
+    return finalizar_base_rank(parcial_base_rank(d), len(d))
+
+def parcial_reten_dist(d: pd.DataFrame) -> pd.DataFrame:
+    return (
         d.groupby("Tempo de retenção (PT)")
         .agg(Retidos=("Remessa", "count"))
         .reset_index()
     )
+
+def finalizar_reten_dist(parcial: pd.DataFrame, total: int) -> pd.DataFrame:
+    reten_dist = parcial.copy()
     reten_dist["Peso"] = reten_dist["Tempo de retenção (PT)"].map(PESO_RETEN_PT).fillna(999)
     reten_dist = reten_dist.sort_values("Peso", ascending=True)
-    reten_dist["%"] = reten_dist["Retidos"] / max(len(d), 1)
+    reten_dist["%"] = reten_dist["Retidos"] / max(total, 1)
     return reten_dist
 
-def top_counts(d: pd.DataFrame, col: str, topn: int) -> pd.DataFrame:
-    if not col or col not in d.columns:
-        return pd.DataFrame()
-    tmp = d[col].dropna()
-    if tmp.empty:
+def build_reten_dist(d: pd.DataFrame) -> pd.DataFrame:
+    return finalizar_reten_dist(parcial_reten_dist(d), len(d))
+
+def parcial_top_counts(d: pd.DataFrame, col: str) -> pd.Series:
+    return d[col].dropna().value_counts()
+
+def finalizar_top_counts(parcial: Optional[pd.Series], col: str, topn: int, total: int) -> pd.DataFrame:
+    if parcial is None or parcial.empty:
         return pd.DataFrame()
-    out = tmp.value_counts().head(topn).reset_index()
+    out = parcial.astype(int).reset_index()
     out.columns = [col, "Qtde"]
-    out["%"] = out["Qtde"] / max(len(d), 1)
+    # desempate pelo nome: mesma lista no modo em memória e no modo arquivo grande
+    out = out.sort_values(["Qtde", col], ascending=[False, True]).head(topn).reset_index(drop=True)
+    out["%"] = out["Qtde"] / max(total, 1)
     return out
 
-def build_coord_rank(d: pd.DataFrame) -> pd.DataFrame:
-    dd = d.dropna(subset=["Coordenador"]).copy()
-    dd = dd[dd["Coordenador"].astype(str).str.strip() != ""]
-    if dd.empty:
+def top_counts(d: pd.DataFrame, col: str, topn: int) -> pd.DataFrame:
+    if not col or col not in d.columns:
         return pd.DataFrame()
+    return finalizar_top_counts(parcial_top_counts(d, col), col, topn, len(d))
 
-    r = (
-        dd.groupby("Coordenador")
+def parcial_coord_rank(d: pd.DataFrame) -> pd.DataFrame:
+    dd = d.dropna(subset=["Coordenador"])
+    dd = dd[dd["Coordenador"].astype(str).str.strip() != ""]
+    return (
+        dd.assign(_mais15=(dd["Peso Criticidade"] >= 20).astype(int))
+        .groupby("Coordenador")
         .agg(
             Retidos=("Remessa", "count"),
-            Media_Criticidade=("Peso Criticidade", "mean"),
-            Qtd_16mais=("Peso Criticidade", lambda s: int((s >= 20).sum())),
+            Soma_Peso=("Peso Criticidade", "sum"),
+            Linhas=("Peso Criticidade", "size"),
+            Qtd_16mais=("_mais15", "sum"),
         )
         .reset_index()
     )
-    r["% Participação"] = r["Retidos"] / max(len(d), 1)
+
+def finalizar_coord_rank(parcial: pd.DataFrame, total: int) -> pd.DataFrame:
+    if parcial.empty:
+        return pd.DataFrame()
+
+    r = parcial.copy()
+    r["Media_Criticidade"] = r["Soma_Peso"] / r["Linhas"]
+    r["Qtd_16mais"] = r["Qtd_16mais"].astype(int)
+    r["% Participação"] = r["Retidos"] / max(total, 1)
     r["Score Misto"] = (
         (r["Retidos"] / max(r["Retidos"].max(), 1)) * 0.6 +
         (r["Media_Criticidade"] / max(r["Media_Criticidade"].max(), 1)) * 0.4
     )
     r = r.sort_values(["Score Misto", "Retidos"], ascending=False)
-    return r
+    return r[["Coordenador", "Retidos", "Media_Criticidade", "Qtd_16mais", "% Participação", "Score Misto"]]
+
+def build_coord_rank(d: pd.DataFrame) -> pd.DataFrame:
+    return finalizar_coord_rank(parcial_coord_rank(d), len(d))
+
+def agregar_em_blocos(blocos: Iterable[pd.DataFrame], col_driver: Optional[str], col_occ: Optional[str]) -> dict:
+    """Soma os parciais de todos os blocos; só os acumuladores ficam em memória."""
+    acum = {"total": 0, "base": None, "reten": None, "coord": None, "driver": None, "occ": None}
+    for d in blocos:
+        acum["total"] += len(d)
+        acum["base"] = somar_parciais(acum["base"], parcial_base_rank(d), GRP_BASE)
+        acum["reten"] = somar_parciais(acum["reten"], parcial_reten_dist(d), ["Tempo de retenção (PT)"])
+        acum["coord"] = somar_parciais(acum["coord"], parcial_coord_rank(d), ["Coordenador"])
+        if col_driver:
+            acum["driver"] = somar_contagens(acum["driver"], parcial_top_counts(d, col_driver))
+        if col_occ:
+            acum["occ"] = somar_contagens(acum["occ"], parcial_top_counts(d, col_occ))
+    return acum
+
+def iterar_blocos_parquet(caminho: str, filtros: dict, colunas: List[str]) -> Iterator[pd.DataFrame]:
+    """Lê só `colunas`, lote a lote; arquivo sem linhas vira um bloco vazio com o schema, como no modo em memória."""
+    arq = pq.ParquetFile(caminho)
+    emitiu = False
+    for lote in arq.iter_batches(batch_size=TAMANHO_BLOCO, columns=colunas):
+        emitiu = True
+        yield aplicar_filtros(lote.to_pandas(), filtros)
+    if not emitiu:
+        yield arq.schema_arrow.empty_table().select(colunas).to_pandas()
+
+@st.cache_data(max_entries=16, show_spinner="Agregando o arquivo em blocos...")
+def agregar_parquet(caminho: str, filtros: dict, col_driver: Optional[str], col_occ: Optional[str]) -> dict:
+    colunas = list(dict.fromkeys(
+        GRP_BASE + ["Remessa", "Peso Criticidade", "Tempo de retenção (PT)"] + [c for c in (col_driver, col_occ) if c]
+    ))
+    return agregar_em_blocos(iterar_blocos_parquet(caminho, filtros, colunas), col_driver, col_occ)
+
+@st.cache_data(max_entries=8, show_spinner="Carregando as linhas da unidade...")
+def carregar_unidade_parquet(caminho: str, unidade: str, grupos: tuple, filtros: dict) -> pd.DataFrame:
+    """Lê só os row groups em que a unidade aparece (índice da conversão), um por vez."""
+    arq = pq.ParquetFile(caminho)
+    partes = []
+    for g in grupos:
+        t = arq.read_row_group(g)
+        partes.append(t.filter(pc.equal(t["Nome da base de entrega"], unidade)))
+    tabela = pa.concat_tables(partes) if partes else arq.schema_arrow.empty_table()
+    return aplicar_filtros(tabela.to_pandas(), filtros)
 
 # ==========================================================
 # MÉTRICAS DO RECORTE
 # ==========================================================
-base_rank = build_base_rank(df_f)
-reten_dist = build_reten_dist(df_f)
-coord_rank = build_coord_rank(df_f)
+if modo_grande:
+    agregado = agregar_parquet(estado["caminho"], filtros, col_driver, col_occ)
+else:
+    agregado = agregar_em_blocos([df_f], col_driver, col_occ)
+
+total_retidos = agregado["total"]
+base_rank = finalizar_base_rank(agregado["base"], total_retidos)
+reten_dist = finalizar_reten_dist(agregado["reten"], total_retidos)
+coord_rank = finalizar_coord_rank(agregado["coord"], total_retidos)
 
 alertas_crit = base_rank[
     (base_rank["% Participação"] >= limiar_alerta_pct) |
@@ -501,8 +823,8 @@ alertas_crit = base_rank[
     (base_rank["Media_Criticidade"] >= limiar_alerta_media)
 ].sort_values(["% Participação", "Qtd_16+", "Media_Criticidade"], ascending=False)
 
-top_drivers = top_counts(df_f, col_driver, top_n) if col_driver else pd.DataFrame()
-top_occs = top_counts(df_f, col_occ, top_n) if col_occ else pd.DataFrame()
+top_drivers = finalizar_top_counts(agregado["driver"], col_driver, top_n, total_retidos) if col_driver else pd.DataFrame()
+top_occs = finalizar_top_counts(agregado["occ"], col_occ, top_n, total_retidos) if col_occ else pd.DataFrame()
 
 # ==========================================================
 # ABAS
@@ -516,10 +838,10 @@ with tab_ger:
     st.subheader("📌 Visão Geral (recorte atual)")
 
     c1, c2, c3, c4 = st.columns(4)
-    c1.metric("Total de retidos", len(df_f))
-    c2.metric("Média criticidade", round(float(df_f["Peso Criticidade"].mean()), 2) if len(df_f) else 0)
-    c3.metric("Qtd 16+ dias", int((df_f["Peso Criticidade"] >= 20).sum()))
-    c4.metric("Unidades no recorte", int(df_f["Nome da base de entrega"].nunique()))
+    c1.metric("Total de retidos", total_retidos)
+    c2.metric("Média criticidade", round(float(base_rank["Soma_Peso"].sum() / total_retidos), 2) if total_retidos else 0)
+    c3.metric("Qtd 16+ dias", int(base_rank["Qtd_16+"].sum()))
+    c4.metric("Unidades no recorte", int(base_rank["Nome da base de entrega"].nunique()))
 
     if not coord_rank.empty:
         st.subheader("🧑‍💼 Ranking de Coordenadores (no recorte)")
@@ -600,17 +922,22 @@ with tab_ger:
 with tab_det:
     st.subheader("🔎 Drill-down por unidade")
 
-    unidades = sorted(df_f["Nome da base de entrega"].unique().tolist())
+    unidades = sorted(base_rank["Nome da base de entrega"].unique().tolist())
     if not unidades:
         st.warning("Sem unidades no recorte atual. Ajuste os filtros.")
         st.stop()
 
     unidade_sel = st.selectbox("Escolha a unidade/base", unidades)
-    d_u = df_f[df_f["Nome da base de entrega"] == unidade_sel].copy()
+    if modo_grande:
+        d_u = carregar_unidade_parquet(
+            estado["caminho"], unidade_sel, estado["indice"].get(unidade_sel, ()), filtros
+        )
+    else:
+        d_u = df_f[df_f["Nome da base de entrega"] == unidade_sel].copy()
 
     c1, c2, c3, c4 = st.columns(4)
     c1.metric("Retidos (unidade)", len(d_u))
-    c2.metric("% participação", f"{(len(d_u)/max(len(df_f),1)):.1%}")
+    c2.metric("% participação", f"{(len(d_u)/max(total_retidos,1)):.1%}")
     c3.metric("Média criticidade", round(float(d_u["Peso Criticidade"].mean()), 2) if len(d_u) else 0)
     c4.metric("Qtd 16+ dias", int((d_u["Peso Criticidade"] >= 20).sum()))
 